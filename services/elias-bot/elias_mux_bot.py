@@ -4,17 +4,39 @@
 import os
 import re
 import time
+import select
 import socket
 import logging
+import threading
+import concurrent.futures
+from collections import OrderedDict, deque
 from typing import Optional, Tuple, Dict
 
 from openai import OpenAI  # openai-python (Responses API)
 
+try:
+    import charset_normalizer
+except ImportError:  # opcjonalne: bez niego zostaje heurystyka utf-8/latin-1
+    charset_normalizer = None
+
 LOG = logging.getLogger("elias-bot")
 
 # --- TinyMUX / telnet helpers -------------------------------------------------
 
 IAC = 255  # telnet "Interpret As Command"
+CHARSET_DETECT_MIN_BYTES = 64  # krótsze linie: za mało danych do zgadywania
+RECV_SIZE = 65536
+REPLY_MAX_BYTES = 780  # TinyMUX tnie linie ~800 bajtów
+ELLIPSIS = "…".encode("utf-8")
+HEALTHCHECK = "@@healthcheck"
+HEALTH_PREFIX = b"page "
+HEALTH_OK = b"=@@ok "
+OUT_QUEUE_MAX = 64  # pełnych linii czekających na wysłanie; najstarsze wypadają
+KEEPALIVE_MS = 60_000  # IDLE do MUX-a po minucie ciszy
+DEDUP_WINDOW_S = 3.0  # ta sama (who, msg) w tym oknie = duplikat
+DEDUP_KEEP_S = 10.0
+DEDUP_PRUNE_EVERY = 100  # linii
+OPENAI_WORKERS = 4  # równoległe zapytania do OpenAI
 
 
 def strip_telnet_iac(data: bytes) -> bytes:
@@ -24,16 +46,22 @@ def strip_telnet_iac(data: bytes) -> bytes:
     - Removes IAC SB ... IAC SE subnegotiations
     Leaves plain text intact.
     """
-    out = bytearray()
+    if IAC not in data:  # memchr; po zalogowaniu prawie zawsze tędy
+        return data if isinstance(data, bytes) else bytes(data)
+
+    out: list[bytes] = []
     i = 0
     n = len(data)
 
     while i < n:
-        b = data[i]
-        if b != IAC:
-            out.append(b)
-            i += 1
-            continue
+        # kopiuj cały odcinek bez IAC jednym slice'em
+        j = data.find(b"\xff", i)
+        if j < 0:
+            out.append(data[i:])
+            break
+        if j > i:
+            out.append(data[i:j])
+        i = j
 
         if i + 1 >= n:
             break
@@ -41,18 +69,14 @@ def strip_telnet_iac(data: bytes) -> bytes:
 
         # IAC IAC => literal 255
         if cmd == IAC:
-            out.append(IAC)
+            out.append(b"\xff")
             i += 2
             continue
 
         # Subnegotiation: IAC SB ... IAC SE
         if cmd == 250:  # SB
-            i += 2
-            while i < n:
-                if data[i] == IAC and i + 1 < n and data[i + 1] == 240:  # SE
-                    i += 2
-                    break
-                i += 1
+            end = data.find(b"\xff\xf0", i + 2)  # IAC SE
+            i = n if end < 0 else end + 2
             continue
 
         # Negotiation: IAC WILL/WONT/DO/DONT <opt>
@@ -63,15 +87,32 @@ def strip_telnet_iac(data: bytes) -> bytes:
         # Other commands: skip IAC + cmd
         i += 2
 
-    return bytes(out)
+    return b"".join(out)
 
 
 def smart_decode(data: bytes) -> str:
-    """Prefer UTF-8, but if it looks broken, fall back to latin-1."""
+    """
+    Prefer UTF-8. If it does not decode cleanly, let charset-normalizer
+    guess for longer lines (when installed), otherwise fall back to latin-1
+    if it looks broken.
+    """
     if not data:
         return ""
+    # czyste ASCII nie zawiera IAC (0xFF) ani bajtów spoza UTF-8: nic do roboty
+    if data.isascii():
+        return data.decode("ascii")
     cleaned = strip_telnet_iac(data)
 
+    try:
+        return cleaned.decode("utf-8")
+    except UnicodeDecodeError:
+        pass
+
+    if charset_normalizer is not None and len(cleaned) >= CHARSET_DETECT_MIN_BYTES:
+        best = charset_normalizer.from_bytes(cleaned).best()
+        if best is not None:
+            return cleaned.decode(best.encoding, errors="replace")
+
     s_utf8 = cleaned.decode("utf-8", errors="replace")
     replacement_ratio = s_utf8.count("\ufffd") / max(1, len(s_utf8))
 
@@ -81,7 +122,8 @@ def smart_decode(data: bytes) -> str:
 
 
 def now_ms() -> int:
-    return int(time.time() * 1000)
+    """Monotonic milliseconds, for measuring intervals only (not wall-clock)."""
+    return time.monotonic_ns() // 1_000_000
 
 
 def normalize_text(s: str) -> str:
@@ -97,10 +139,35 @@ def build_client() -> OpenAI:
     return OpenAI(api_key=api_key)
 
 
+# cache odpowiedzi: (model, znormalizowany prompt, 5-min bucket) -> tekst
+REPLY_CACHE_SIZE = 512
+REPLY_CACHE_TTL_S = 300
+_REPLY_CACHE: "OrderedDict[Tuple[str, str, int], str]" = OrderedDict()
+_REPLY_CACHE_LOCK = threading.Lock()  # elias_reply działa w wątkach puli
+
+
 def elias_reply(client: OpenAI, model: str, prompt: str) -> str:
     """
     Elias: krótko, niejednoznacznie, bez meta-systemów.
+    Powtarzające się pytania (po normalizacji) obsługuje z cache (LRU + TTL).
     """
+    key = (model, normalize_text(prompt), time.monotonic_ns() // (REPLY_CACHE_TTL_S * 1_000_000_000))
+    with _REPLY_CACHE_LOCK:
+        cached = _REPLY_CACHE.get(key)
+        if cached is not None:
+            _REPLY_CACHE.move_to_end(key)
+            return cached
+
+    text = _elias_reply_uncached(client, model, prompt)
+    if text != "…":
+        with _REPLY_CACHE_LOCK:
+            _REPLY_CACHE[key] = text
+            if len(_REPLY_CACHE) > REPLY_CACHE_SIZE:
+                _REPLY_CACHE.popitem(last=False)
+    return text
+
+
+def _elias_reply_uncached(client: OpenAI, model: str, prompt: str) -> str:
     system = (
         "Jesteś Eliasem, wampirem w śnieżnej Finlandii."
         "Jesteś Malkawianem według systemu World of Darkness Vampire the Masquerade 20th Anniversary Edition."
@@ -132,31 +199,80 @@ def elias_reply(client: OpenAI, model: str, prompt: str) -> str:
 
 # --- Parsing patterns ----------------------------------------------------------
 
-PAGE_PATTERNS = [
-    re.compile(r"^(?P<who>.+?)\s+pages:\s*(?P<msg>.*)$", re.IGNORECASE),
-    re.compile(r"^From afar,\s+(?P<who>.+?)\s+pages:\s*(?P<msg>.*)$", re.IGNORECASE),
-    re.compile(r"^You sense that\s+(?P<who>.+?)\s+is looking for you\.?\s*(?P<msg>.*)$", re.IGNORECASE),
-]
-
-SAY_PATTERNS = [
+# Wszystkie formaty page/say w jednym wzorcu: jedno przejście regexa na linię.
+# Alternatywa, która trafiła, jest w m.lastindex (kolejność = priorytet).
+LINE_PATTERN = re.compile(
+    r"^(?:"
+    r"(?P<page_afar>From afar,\s+(?P<who_afar>.+?)\s+pages:\s*(?P<msg_afar>.*))"
+    r"|(?P<page_sense>You sense that\s+(?P<who_sense>.+?)\s+is looking for you\.?\s*(?P<msg_sense>.*))"
+    r"|(?P<page>(?P<who_page>.+?)\s+pages:\s*(?P<msg_page>.*))"
     # PL: Wizard mówi: „Elias, jaka dzisiaj jest noc?”
-    re.compile(r"^(?P<who>.+?)\s+mówi:\s*[„\"](?P<msg>.*?)[”\"]\s*$", re.IGNORECASE),
+    r"|(?P<say_pl>(?P<who_pl>.+?)\s+mówi:\s*[„\"](?P<msg_pl>.*?)[”\"]\s*)"
     # EN: Wizard says, "Elias, what night is it?"
-    re.compile(r"^(?P<who>.+?)\s+says,?\s*[\"“](?P<msg>.*?)[\"”]\s*$", re.IGNORECASE),
-]
+    r"|(?P<say_en>(?P<who_en>.+?)\s+says,?\s*[\"“](?P<msg_en>.*?)[\"”]\s*)"
+    r")$",
+    re.IGNORECASE,
+)
+
+# numer grupy alternatywy -> rodzaj; who/msg to zawsze dwie kolejne grupy
+_LINE_KINDS = {
+    LINE_PATTERN.groupindex[name]: kind
+    for name, kind in (
+        ("page_afar", "page"),
+        ("page_sense", "page"),
+        ("page", "page"),
+        ("say_pl", "say"),
+        ("say_en", "say"),
+    )
+}
 
-# wołanie Eliasa na początku wypowiedzi (Elias, ... / Elias: ... / @Elias ...)
-CALL_ELIAS = re.compile(r"^\s*(?:@?Elias\b[:,]?\s*)(?P<rest>.*)$", re.IGNORECASE)
+# bound .match method: bez lookupu atrybutu w każdej iteracji
+_LINE_MATCH = LINE_PATTERN.match
+
+
+def parse_line(line: str) -> Optional[Tuple[str, str, str]]:
+    """Return (kind, who, msg) where kind is "page" or "say", else None."""
+    m = _LINE_MATCH(line.strip())
+    if not m:
+        return None
+    i = m.lastindex
+    who, msg = m.group(i + 1, i + 2)
+    return _LINE_KINDS[i], who.strip(), (msg or "").strip()
+
+
+def parse_page(line: str) -> Optional[Tuple[str, str]]:
+    parsed = parse_line(line)
+    if parsed and parsed[0] == "page":
+        return parsed[1], parsed[2]
+    return None
 
 
 def parse_say(line: str) -> Optional[Tuple[str, str]]:
-    for pat in SAY_PATTERNS:
-        m = pat.match(line.strip())
-        if m:
-            return m.group("who").strip(), (m.group("msg") or "").strip()
+    parsed = parse_line(line)
+    if parsed and parsed[0] == "say":
+        return parsed[1], parsed[2]
     return None
 
 
+def call_elias(msg: str) -> Optional[str]:
+    """
+    Return the rest of the message if it addresses Elias, else None.
+    Wołanie na początku wypowiedzi: Elias, ... / Elias: ... / @Elias ...
+    """
+    s = msg.lstrip()
+    if s[:1] == "@":
+        s = s[1:]
+    if s[:5].lower() != "elias":
+        return None
+    rest = s[5:]
+    # granica słowa: "Eliasz" to nie wołanie
+    if rest[:1].isalnum() or rest[:1] == "_":
+        return None
+    if rest[:1] in (":", ","):
+        rest = rest[1:]
+    return rest.strip()
+
+
 # --- Main bot -----------------------------------------------------------------
 
 class EliasMuxBot:
@@ -170,21 +286,36 @@ class EliasMuxBot:
 
         self.sock: Optional[socket.socket] = None
         self.buf = bytearray()
+        self.buf_off = 0  # początek nieprzeczytanej części self.buf
         self.last_activity_ms = now_ms()
 
+        # kolejka wyjściowa: wysyłana przy okazji select() w recv_bytes
+        self.out_q: deque[bytes] = deque()
+        # niewysłana reszta linii już częściowo wysłanej; nigdy nie wypada
+        self._out_head = b""
+
         # dedupe "mówi" + "says" / powtórki w krótkim oknie czasu
         self.recent_say: Dict[tuple[str, str], float] = {}  # (who_norm, prompt_norm) -> ts
 
         self.oa = build_client()
 
+        # OpenAI poza pętlą I/O; gotowe odpowiedzi wracają przez self.replies
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=OPENAI_WORKERS, thread_name_prefix="elias-openai"
+        )
+        self.replies: deque[Tuple[str, str]] = deque()  # (who, answer)
+
     # --- socket IO ---
 
     def connect(self):
         LOG.info("Connecting to %s:%s", self.mux_host, self.mux_port)
         s = socket.create_connection((self.mux_host, self.mux_port), timeout=15)
-        s.settimeout(0.5)
+        s.setblocking(False)
         self.sock = s
         self.buf.clear()
+        self.buf_off = 0
+        self.out_q.clear()
+        self._out_head = b""
         self.last_activity_ms = now_ms()
 
     def close(self):
@@ -194,21 +325,74 @@ class EliasMuxBot:
             except Exception:
                 pass
         self.sock = None
+        self.pool.shutdown(wait=False, cancel_futures=True)
 
     def send_line(self, line: str):
-        if not self.sock:
-            return
         data = (line.rstrip("\n") + "\n").encode("utf-8", errors="replace")
-        self.sock.sendall(data)
-        LOG.debug(">> %s", line)
+        self.send_bytes(data)
 
-    def recv_bytes(self) -> bytes:
+    def send_bytes(self, data: bytes):
+        """Queue one already-encoded line (with trailing newline)."""
+        if not self.sock:
+            return
+        if data in self.out_q:
+            LOG.debug(">> (already queued) %r", data)
+            return
+        if len(self.out_q) >= OUT_QUEUE_MAX:
+            # w kolejce są tylko linie jeszcze nietknięte, więc można je wyrzucić
+            LOG.warning("Outbound queue full, dropping oldest line")
+            self.out_q.popleft()
+        self.out_q.append(data)
+        LOG.debug(">> %r", data)
+
+    def flush_out(self):
+        """Send as much of the outbound queue as the socket accepts now."""
+        q = self.out_q
+        while (self._out_head or q) and self.sock:
+            if not self._out_head:
+                self._out_head = q.popleft()
+            try:
+                n = self.sock.send(self._out_head)
+            except BlockingIOError:
+                return
+            except Exception as e:
+                raise ConnectionError(str(e))
+            self._out_head = self._out_head[n:]
+            if self._out_head:
+                return
+
+    def has_output(self) -> bool:
+        return bool(self._out_head or self.out_q)
+
+    def recv_bytes(self, wait_s: float = 0.05) -> bytes:
+        """
+        Wait up to wait_s for the socket, flush pending output if writable,
+        then drain everything there is to read.
+        """
         if not self.sock:
             return b""
         try:
-            return self.sock.recv(4096)
-        except socket.timeout:
-            return b""
+            readable, writable, _ = select.select(
+                [self.sock], [self.sock] if self.has_output() else [], [], wait_s
+            )
+            if writable:
+                self.flush_out()
+            if not readable:
+                return b""
+            chunks: list[bytes] = []
+            while True:
+                try:
+                    c = self.sock.recv(RECV_SIZE)
+                except BlockingIOError:
+                    break
+                if not c:
+                    if not chunks:
+                        raise ConnectionError("socket closed by peer")
+                    break
+                chunks.append(c)
+            return b"".join(chunks)
+        except ConnectionError:
+            raise
         except Exception as e:
             raise ConnectionError(str(e))
 
@@ -219,37 +403,138 @@ class EliasMuxBot:
             self.last_activity_ms = now_ms()
 
         lines: list[str] = []
-        while b"\n" in self.buf:
-            raw_line, _, rest = self.buf.partition(b"\n")
-            self.buf = bytearray(rest)
-            line = smart_decode(raw_line).rstrip("\r")
+        buf = self.buf
+        off = self.buf_off
+        while True:
+            idx = buf.find(b"\n", off)
+            if idx < 0:
+                break
+            line = smart_decode(buf[off:idx]).rstrip("\r")
+            off = idx + 1
             if line.strip():
                 lines.append(line)
+
+        # kompaktuj dopiero, gdy zużyta część przeważa (koszt zamortyzowany)
+        if off and off * 2 >= len(buf):
+            del buf[:off]
+            off = 0
+        self.buf_off = off
         return lines
 
     # --- login / settle ---
 
+    def settle(self, idle_s: float = 0.2, max_s: float = 5.0) -> list[str]:
+        """Read until the server has been quiet for idle_s (at most max_s)."""
+        lines: list[str] = []
+        deadline = time.monotonic() + max_s
+        while self.sock and time.monotonic() < deadline:
+            self.flush_out()
+            readable, _, _ = select.select([self.sock], [], [], idle_s)
+            if not readable and not self.has_output():
+                break
+            lines.extend(self.read_lines())
+        return lines
+
     def login_and_settle(self):
         if not self.mux_pass:
             raise RuntimeError("MUX_PASS missing in environment")
 
         # flush banner
-        t0 = time.time()
-        while time.time() - t0 < 2.0:
-            _ = self.read_lines()
-            time.sleep(0.05)
+        _ = self.settle()
 
         self.send_line(f"connect {self.mux_user} {self.mux_pass}")
 
         # give server time to respond
-        t1 = time.time()
-        while time.time() - t1 < 2.0:
-            for ln in self.read_lines():
-                LOG.info("<< %s", ln)
-            time.sleep(0.05)
+        for ln in self.settle():
+            LOG.info("<< %s", ln)
 
         # Try to get into
 
+    # --- main loop ---
+
+    def is_duplicate(self, who: str, msg: str) -> bool:
+        """True if the same (who, msg) was handled within DEDUP_WINDOW_S."""
+        key = (normalize_text(who), normalize_text(msg))
+        now = time.monotonic()
+        if self.recent_say.get(key, 0.0) > now - DEDUP_WINDOW_S:
+            return True
+        self.recent_say[key] = now
+        return False
+
+    def prune_recent(self):
+        cutoff = time.monotonic() - DEDUP_KEEP_S
+        self.recent_say = {k: ts for k, ts in self.recent_say.items() if ts >= cutoff}
+
+    def send_healthcheck(self, who: str):
+        self.send_bytes(
+            HEALTH_PREFIX + who.encode("utf-8", errors="replace")
+            + HEALTH_OK + str(int(time.time())).encode() + b"\n"
+        )
+
+    def handle_and_reply(self, who: str, msg: str):
+        LOG.info("Ask from %s: %s", who, msg)
+        fut = self.pool.submit(elias_reply, self.oa, self.model, msg)
+        fut.add_done_callback(lambda f: self._enqueue_reply(who, f))
+
+    def _enqueue_reply(self, who: str, fut: concurrent.futures.Future):
+        # wątek puli: tylko odkładamy wynik, wysyła pętla główna
+        if fut.cancelled():
+            return
+        try:
+            answer = fut.result()
+        except Exception as e:
+            LOG.warning("OpenAI error: %s", e)
+            return
+        self.replies.append((who, answer))
+
+    def send_reply(self, who: str, answer: str):
+        # limit MUX-a jest w bajtach, nie w znakach (polskie znaki = 2 bajty)
+        body = " ".join(answer.splitlines()).strip().encode("utf-8", errors="replace")
+        if len(body) > REPLY_MAX_BYTES:
+            cut = REPLY_MAX_BYTES
+            while cut and (body[cut] & 0xC0) == 0x80:  # nie tnij w środku znaku
+                cut -= 1
+            body = body[:cut].rstrip() + ELLIPSIS
+        self.send_bytes(b"page " + who.encode("utf-8", errors="replace") + b"=" + body + b"\n")
+
+    def loop(self):
+        LOG.info("Listening as %s", self.mux_user)
+        seen = 0
+        while self.sock:
+            for line in self.read_lines():
+                LOG.debug("<< %s", line)
+                seen += 1
+                if seen % DEDUP_PRUNE_EVERY == 0:
+                    self.prune_recent()
+
+                parsed = parse_line(line)
+                if not parsed:
+                    continue
+                kind, who, msg = parsed
+
+                if kind == "say":
+                    # na sali odpowiadamy tylko, gdy ktoś woła Eliasa
+                    prompt = call_elias(msg)
+                    if prompt is None:
+                        continue
+                    msg = prompt
+
+                # healthcheck przed dedupe i zanim w ogóle dotkniemy OpenAI
+                if msg == HEALTHCHECK:
+                    self.send_healthcheck(who)
+                    continue
+
+                if not msg or self.is_duplicate(who, msg):
+                    continue
+                self.handle_and_reply(who, msg)
+
+            while self.replies:
+                self.send_reply(*self.replies.popleft())
+
+            if now_ms() - self.last_activity_ms > KEEPALIVE_MS:
+                self.send_line("IDLE")
+                self.last_activity_ms = now_ms()
+
 
 def main():
     logging.basicConfig(
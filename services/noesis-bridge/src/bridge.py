@@ -3,33 +3,35 @@ from __future__ import annotations
 
 import json
 import os
-import re
+import select
+import selectors
 import socket
+import sys
 import time
-import uuid
-import threading
 from dataclasses import dataclass
-from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Optional
 
 import yaml
-from writer import EventWriter
+from timeutil import iso_utc_date, iso_utc_now_ms
+from writer import BUFFER_SIZE, FLUSH_BYTES, FLUSH_INTERVAL_S, EventWriter, dumps_bytes
 
+_PID = os.getpid()
+RECV_SIZE = 65536
+CR_TO_LF = bytes.maketrans(b"\r", b"\n")
+HEARTBEAT_INTERVAL_S = 30.0
+PING_INTERVAL_S = 20.0
+SEND_TIMEOUT_S = 2.0  # jak dawne settimeout(2.0) na całą linię
 
-def iso_utc_now_ms() -> str:
-    dt = datetime.now(timezone.utc)
-    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{int(dt.microsecond / 1000):03d}Z"
-
-
-def iso_utc_date() -> str:
-    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+try:
+    from yaml import CSafeLoader as _SafeLoader  # libyaml
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
 
 
 def make_run_id() -> str:
-    started = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-    suffix = uuid.uuid4().hex[:6]
-    return f"{started}-{suffix}"
+    started = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    return f"{started}-{os.urandom(3).hex()}"
 
 
 @dataclass
@@ -43,13 +45,14 @@ class BridgeConfig:
     logs_subdir: str = "logs"
     log_level: str = "INFO"
     mode_name: str = "dry_run"  # dry_run | record
+    log_echo_stdout: bool = True
 
 
 def load_config(path: Path) -> BridgeConfig:
     if not path.exists():
         raise FileNotFoundError(f"Config not found: {path}")
 
-    data = yaml.safe_load(path.read_text(encoding="utf-8")) or {}
+    data = yaml.load(path.read_text(encoding="utf-8"), Loader=_SafeLoader) or {}
 
     def get(dct: Dict[str, Any], *keys: str) -> Any:
         cur: Any = dct
@@ -69,6 +72,7 @@ def load_config(path: Path) -> BridgeConfig:
     logs_subdir = get(data, "output", "logs_subdir") or "logs"
     log_level = get(data, "logging", "level") or "INFO"
     mode_name = get(data, "mode", "name") or "dry_run"
+    log_echo_stdout = get(data, "logging", "echo_stdout")
 
     if not isinstance(host, str) or not host.strip():
         raise ValueError("Invalid config: connection.host must be a non-empty string")
@@ -85,6 +89,12 @@ def load_config(path: Path) -> BridgeConfig:
     if mode_name not in ("dry_run", "record"):
         raise ValueError("Invalid config: mode.name must be 'dry_run' or 'record'")
 
+    # domyślnie z echem na stdout (journald); wyłączenie tylko jawnie
+    if log_echo_stdout is None:
+        log_echo_stdout = True
+    if not isinstance(log_echo_stdout, bool):
+        raise ValueError("Invalid config: logging.echo_stdout must be a boolean")
+
     return BridgeConfig(
         host=host.strip(),
         port=port,
@@ -95,15 +105,19 @@ def load_config(path: Path) -> BridgeConfig:
         logs_subdir=str(logs_subdir),
         log_level=str(log_level).upper(),
         mode_name=mode_name,
+        log_echo_stdout=log_echo_stdout,
     )
 
 
 class TechLogger:
-    def __init__(self, log_dir: Path, level: str = "INFO") -> None:
+    def __init__(self, log_dir: Path, level: str = "INFO", echo: bool = True) -> None:
         self.log_dir = log_dir
         self.level = level
+        self._echo = echo
         self._fh: Optional[Any] = None
         self._current_day: Optional[str] = None
+        self._bytes_since_flush = 0
+        self._last_flush_ts = 0.0
 
     def _ensure_open(self) -> None:
         day = iso_utc_date()
@@ -116,15 +130,36 @@ class TechLogger:
                 pass
         self.log_dir.mkdir(parents=True, exist_ok=True)
         path = self.log_dir / f"bridge-{day}.log"
-        self._fh = open(path, "a", encoding="utf-8")
+        self._fh = open(path, "a", encoding="utf-8", buffering=BUFFER_SIZE)
         self._current_day = day
+        self._bytes_since_flush = 0
+        self._last_flush_ts = time.monotonic()
 
     def log(self, msg: str) -> None:
         self._ensure_open()
         line = f"{iso_utc_now_ms()} {msg}\n"
         self._fh.write(line)
-        self._fh.flush()
-        print(line, end="")
+        self._bytes_since_flush += len(line)
+        self.maybe_flush()
+        if self._echo:
+            sys.stdout.write(line)
+
+    def maybe_flush(self) -> None:
+        if not self._fh or not self._bytes_since_flush:
+            return
+        if (
+            self._bytes_since_flush >= FLUSH_BYTES
+            or time.monotonic() - self._last_flush_ts >= FLUSH_INTERVAL_S
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        if self._fh:
+            self._fh.flush()
+        if self._echo:
+            sys.stdout.flush()
+        self._bytes_since_flush = 0
+        self._last_flush_ts = time.monotonic()
 
     def close(self) -> None:
         if self._fh:
@@ -142,50 +177,84 @@ class MuxClient:
         self.port = port
         self.logger = logger
         self.sock: Optional[socket.socket] = None
+        # jeden bufor recv na cały czas życia klienta (bez alokacji na recv)
+        self._recv_view = memoryview(bytearray(RECV_SIZE))
 
     def connect(self, timeout_s: float = 10.0) -> None:
         self.logger.log(f"[mux] connecting to {self.host}:{self.port}")
         s = socket.create_connection((self.host, self.port), timeout=timeout_s)
-        s.settimeout(2.0)
+        s.setblocking(False)
         self.sock = s
         self.logger.log("[mux] connected")
 
-    def recv_some(self) -> str:
+    def recv_into(self, out: bytearray, timeout_s: float = 0.0) -> int:
+        """
+        Drain everything currently readable into out (via a reusable recv
+        buffer) and return the number of bytes appended. With timeout_s > 0,
+        first wait up to that long for the socket to become readable.
+        """
         if not self.sock:
-            return ""
+            return 0
+        total = 0
         try:
-            data = self.sock.recv(4096)
-            if data == b"":
-                # peer closed connection
-                raise ConnectionError("socket closed by peer")
-            return data.decode("utf-8", errors="replace")
-        except socket.timeout:
-            return ""
+            if timeout_s > 0:
+                readable, _, _ = select.select([self.sock], [], [], timeout_s)
+                if not readable:
+                    return 0
+            mv = self._recv_view
+            while True:
+                try:
+                    n = self.sock.recv_into(mv)
+                except BlockingIOError:
+                    break
+                if n == 0:
+                    if total:
+                        break
+                    # peer closed connection
+                    raise ConnectionError("socket closed by peer")
+                out += mv[:n]
+                total += n
+            return total
         except Exception as e:
             self.logger.log(f"[mux] recv error: {e}")
             self.close()
-            return ""
+            return total
 
     def send_line(self, line: str) -> None:
         if not self.sock:
             raise RuntimeError("Not connected")
-        self.sock.sendall((line + "\n").encode("utf-8"))
+        view = memoryview((line + "\n").encode("utf-8"))
+        deadline = time.monotonic() + SEND_TIMEOUT_S
+        while view:
+            try:
+                n = self.sock.send(view)
+            except BlockingIOError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("send timed out")
+                select.select([], [self.sock], [], remaining)
+                continue
+            view = view[n:]
+
+    def _recv_for(self, seconds: float) -> str:
+        out = bytearray()
+        deadline = time.time() + seconds
+        while self.sock:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.recv_into(out, timeout_s=remaining)
+        return out.decode("utf-8", errors="replace")
 
     def login(self, username: str, password: str) -> None:
-        banner = ""
-        start = time.time()
-        while time.time() - start < 2.0:
-            banner += self.recv_some()
+        banner = self._recv_for(2.0)
         if banner.strip():
             self.logger.log("[mux] banner received")
 
         self.logger.log(f"[mux] logging in as {username}")
         self.send_line(f"connect {username} {password}")
 
-        resp = ""
-        start = time.time()
-        while time.time() - start < 3.0:
-            resp += self.recv_some()
+        resp = self._recv_for(3.0)
 
         if "Either that player does not exist" in resp:
             self.logger.log("[mux] login failed: bad username/password")
@@ -194,10 +263,7 @@ class MuxClient:
         self.logger.log("[mux] login response received (ok)")
 
         self.send_line("who")
-        who_resp = ""
-        start = time.time()
-        while time.time() - start < 2.0:
-            who_resp += self.recv_some()
+        who_resp = self._recv_for(2.0)
         if who_resp.strip():
             self.logger.log("[mux] WHO ok")
 
@@ -210,58 +276,58 @@ class MuxClient:
         self.sock = None
 
 
-class KeepAlive(threading.Thread):
-    def __init__(self, mux: MuxClient, logger: TechLogger, interval_s: int = 20) -> None:
-        super().__init__(daemon=True)
-        self.mux = mux
-        self.logger = logger
-        self.interval_s = interval_s
-        self.last_pong_ts: Optional[float] = None
-
-    def run(self) -> None:
-        while True:
-            try:
-                if self.mux.sock:
-                    self.mux.send_line("+ping")
-            except Exception as e:
-                self.logger.log(f"[keepalive] send error: {e}")
-            time.sleep(self.interval_s)
-
-
-def write_json_atomic(path: Path, payload: Dict[str, Any]) -> None:
+def write_json_atomic(path: Path, payload: Dict[str, Any], indent: Optional[int] = None) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
     tmp = path.with_suffix(path.suffix + ".tmp")
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False)
+    if indent is None:
+        data = dumps_bytes(payload)
+    else:
+        data = (json.dumps(payload, indent=indent, ensure_ascii=False) + "\n").encode("utf-8")
+    with open(tmp, "wb") as f:
+        f.write(data)
     os.replace(tmp, path)
 
 
-NOESIS_PREFIX_RE = re.compile(r"^\s*NOESIS:?\s*(.*)$")
+NOESIS_PREFIX = "NOESIS"
+NOESIS_PREFIX_B = NOESIS_PREFIX.encode("ascii")
 
 
 def parse_noesis_kv(line: str) -> Optional[Dict[str, str]]:
-    m = NOESIS_PREFIX_RE.match(line)
-    if not m:
+    # tani prescreen: większość linii z MUX-a to nie telemetria
+    s = line.lstrip()
+    if not s.startswith(NOESIS_PREFIX):
         return None
-    payload = m.group(1).strip()
+    payload = s[len(NOESIS_PREFIX):]
+    if payload[:1] == ":":
+        payload = payload[1:]
+    payload = payload.strip()
     if not payload:
         return None
-    parts = [p for p in payload.split("|") if p]
     kv: Dict[str, str] = {}
-    for p in parts:
-        if "=" not in p:
+    for p in payload.split("|"):
+        eq = p.find("=")
+        if eq < 0:
             continue
-        k, v = p.split("=", 1)
-        kv[k.strip()] = v.strip()
+        kv[p[:eq].strip()] = p[eq + 1:].strip()
     return kv if kv else None
 
 
+# Stały kształt zdarzeń (kolejność kluczy = kolejność w JSONL).
+_SAY_PROTO: Dict[str, Any] = {
+    "ts_utc": "", "run_id": "", "seq": 0, "type": "SAY",
+    "actor": None, "location": None, "content": None, "perception": None,
+}
+_MOVE_PROTO: Dict[str, Any] = dict(_SAY_PROTO, type="MOVE")
+# współdzielona pusta lista: zdarzenia tylko serializujemy, nikt jej nie mutuje
+_NO_OCCLUSION: list = []
+
+
 def main() -> int:
     cfg_path = Path(os.environ.get("NOESIS_BRIDGE_CONFIG", "config.yaml")).resolve()
     cfg = load_config(cfg_path)
 
     run_id = make_run_id()
-    started_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
     out_base = cfg.out_dir
     meta_dir = out_base / cfg.meta_subdir
@@ -269,7 +335,7 @@ def main() -> int:
     meta_dir.mkdir(parents=True, exist_ok=True)
     logs_dir.mkdir(parents=True, exist_ok=True)
 
-    logger = TechLogger(logs_dir, level=cfg.log_level)
+    logger = TechLogger(logs_dir, level=cfg.log_level, echo=cfg.log_echo_stdout)
     logger.log(f"[bridge] starting run_id={run_id} config={cfg_path}")
     logger.log(f"[bridge] mode={cfg.mode_name}")
 
@@ -278,43 +344,130 @@ def main() -> int:
         "started_at_utc": started_at,
         "host": cfg.host,
         "port": cfg.port,
-        "pid": os.getpid(),
+        "pid": _PID,
         "bridge_version": "0.5-keepalive-hb",
         "auth_user": cfg.username,
     }
     meta_path = meta_dir / f"run-{run_id}.json"
-    meta_path.write_text(json.dumps(meta, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+    write_json_atomic(meta_path, meta, indent=2)
     logger.log(f"[bridge] wrote run meta: {meta_path}")
 
     mux = MuxClient(cfg.host, cfg.port, logger)
     writer = EventWriter(out_dir=cfg.out_dir)
 
     seq = 0
-    buffer = ""
+    buffer = bytearray()
     last_event_rx_ts = time.time()
     last_event_write_ts = 0.0
     events_written = 0
 
+    # heartbeat jest tylko informacyjny i nadpisywany co 30 s: zwykły zapis,
+    # bez tmp + rename (ten zostaje dla run meta); katalog = out_dir, już istnieje
     hb_path = cfg.out_dir / "bridge.heartbeat.json"
-    last_hb_emit = 0.0
+    # terminy na zegarze monotonicznym: skok zegara ściennego ich nie rusza
+    next_hb_deadline = time.monotonic()
+    next_ping_deadline = time.monotonic() + PING_INTERVAL_S
+
+    sel = selectors.DefaultSelector()
+    watched: Optional[socket.socket] = None
+
+    def watch() -> None:
+        # (re)rejestracja gniazda MUX-a w selektorze po connect/reconnect
+        nonlocal watched
+        if watched is not None:
+            try:
+                sel.unregister(watched)
+            except (KeyError, ValueError):
+                pass
+        watched = mux.sock
+        if watched is not None:
+            sel.register(watched, selectors.EVENT_READ)
 
     def reconnect() -> None:
-        nonlocal buffer
         logger.log("[mux] reconnecting...")
         mux.close()
         time.sleep(1.0)
         mux.connect()
         mux.login(cfg.username, cfg.password)
-        buffer = ""
+        watch()
+        buffer.clear()
         logger.log("[mux] reconnected + logged in")
 
+    def emit(event: Dict[str, Any]) -> Path:
+        nonlocal events_written, last_event_write_ts
+        # flush dopiero po całym recv (maybe_flush na końcu pętli)
+        path = writer.append_event(event)
+        events_written += 1
+        last_event_write_ts = time.time()
+        return path
+
+    # prototypy zdarzeń z wpisanym run_id; handler robi .copy() i uzupełnia resztę
+    say_proto = dict(_SAY_PROTO, run_id=run_id)
+    move_proto = dict(_MOVE_PROTO, run_id=run_id)
+
+    def handle_say(kv: Dict[str, str], line: str) -> None:
+        nonlocal seq
+        actor = kv.get("actor")
+        loc = kv.get("loc")
+        raw = kv.get("raw", "")
+        verb = kv.get("verb")
+
+        if not actor or not loc:
+            logger.log(f"[telemetry] drop SAY missing actor/loc line={line}")
+            return
+
+        seq += 1
+        content: Dict[str, Any] = {"raw": raw}
+        if verb:
+            content["verb"] = verb
+
+        event = say_proto.copy()
+        event["ts_utc"] = iso_utc_now_ms()
+        event["seq"] = seq
+        event["actor"] = {"dbref": actor, "name": actor}
+        event["location"] = {"dbref": loc, "name": loc}
+        event["content"] = content
+        event["perception"] = {"perceived_by": [actor], "occluded_for": _NO_OCCLUSION}
+
+        path = emit(event)
+        logger.log(f"[event] wrote SAY seq={seq} actor={actor} loc={loc} file={path}")
+
+    def handle_move(kv: Dict[str, str], line: str) -> None:
+        nonlocal seq
+        actor = kv.get("actor")
+        frm = kv.get("from")
+        to = kv.get("to")
+        raw = kv.get("raw", "")
+
+        if not actor or not frm or not to:
+            logger.log(f"[telemetry] drop MOVE missing actor/from/to line={line}")
+            return
+
+        seq += 1
+        event = move_proto.copy()
+        event["ts_utc"] = iso_utc_now_ms()
+        event["seq"] = seq
+        event["actor"] = {"dbref": actor, "name": actor}
+        event["location"] = {"dbref": to, "name": to}
+        event["content"] = {"from": frm, "to": to, "raw": raw}
+        event["perception"] = {"perceived_by": [actor], "occluded_for": _NO_OCCLUSION}
+
+        path = emit(event)
+        logger.log(f"[event] wrote MOVE seq={seq} actor={actor} from={frm} to={to} file={path}")
+
+    # typ telemetrii (t=...) -> handler
+    handlers: Dict[str, Callable[[Dict[str, str], str], None]] = {
+        "SAY": handle_say,
+        "MOVE": handle_move,
+    }
+
     try:
         mux.connect()
         mux.login(cfg.username, cfg.password)
+        watch()
         logger.log("[bridge] READY (connected + logged in)")
 
-        KeepAlive(mux, logger, interval_s=20).start()
-
+        record = cfg.mode_name == "record"
         if cfg.mode_name == "dry_run":
             logger.log("[bridge] DRY RUN: telemetry ignored.")
         else:
@@ -324,104 +477,69 @@ def main() -> int:
             if not mux.sock:
                 reconnect()
 
-            chunk = mux.recv_some()
-            if chunk:
+            # śpij do danych z MUX-a albo do najbliższego heartbeatu / pinga / flush
+            next_deadline = min(next_hb_deadline, next_ping_deadline)
+            timeout = max(0.0, next_deadline - time.monotonic())
+            events = sel.select(min(timeout, FLUSH_INTERVAL_S))
+
+            start = len(buffer)
+            if events and mux.recv_into(buffer):
                 last_event_rx_ts = time.time()
-                buffer += chunk.replace("\r", "\n")
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    line = line.strip()
-                    if not line:
+                # CR -> LF tylko na nowo dopisanym kawałku, nie na całym buforze
+                if buffer.find(b"\r", start) >= 0:
+                    buffer[start:] = buffer[start:].translate(CR_TO_LF)
+                while True:
+                    idx = buffer.find(b"\n")
+                    if idx < 0:
+                        break
+                    raw_line = buffer[:idx]
+                    del buffer[:idx + 1]
+
+                    if not record:
                         continue
-
-                    if cfg.mode_name != "record":
+                    # zwykły czat z MUX-a: odrzuć przed decode/strip
+                    if NOESIS_PREFIX_B not in raw_line:
                         continue
 
+                    line = raw_line.decode("utf-8", errors="replace").strip()
                     kv = parse_noesis_kv(line)
                     if kv is None:
                         continue
 
-                    t = kv.get("t")
-                    if not t:
-                        continue
-
-                    if t == "SAY":
-                        actor = kv.get("actor")
-                        loc = kv.get("loc")
-                        raw = kv.get("raw", "")
-                        verb = kv.get("verb")
-
-                        if not actor or not loc:
-                            logger.log(f"[telemetry] drop SAY missing actor/loc line={line}")
-                            continue
-
-                        seq += 1
-                        content: Dict[str, Any] = {"raw": raw}
-                        if verb:
-                            content["verb"] = verb
-
-                        event = {
-                            "ts_utc": iso_utc_now_ms(),
-                            "run_id": run_id,
-                            "seq": seq,
-                            "type": "SAY",
-                            "actor": {"dbref": actor, "name": actor},
-                            "location": {"dbref": loc, "name": loc},
-                            "content": content,
-                            "perception": {"perceived_by": [actor], "occluded_for": []},
-                        }
-
-                        path = writer.write_event(event)
-                        events_written += 1
-                        last_event_write_ts = time.time()
-                        logger.log(f"[event] wrote SAY seq={seq} actor={actor} loc={loc} file={path}")
-                        continue
+                    handler = handlers.get(kv.get("t", ""))
+                    if handler is not None:
+                        handler(kv, line)
 
-                    if t == "MOVE":
-                        actor = kv.get("actor")
-                        frm = kv.get("from")
-                        to = kv.get("to")
-                        raw = kv.get("raw", "")
-
-                        if not actor or not frm or not to:
-                            logger.log(f"[telemetry] drop MOVE missing actor/from/to line={line}")
-                            continue
-
-                        seq += 1
-                        event = {
-                            "ts_utc": iso_utc_now_ms(),
-                            "run_id": run_id,
-                            "seq": seq,
-                            "type": "MOVE",
-                            "actor": {"dbref": actor, "name": actor},
-                            "location": {"dbref": to, "name": to},
-                            "content": {"from": frm, "to": to, "raw": raw},
-                            "perception": {"perceived_by": [actor], "occluded_for": []},
-                        }
-
-                        path = writer.write_event(event)
-                        events_written += 1
-                        last_event_write_ts = time.time()
-                        logger.log(f"[event] wrote MOVE seq={seq} actor={actor} from={frm} to={to} file={path}")
-                        continue
+            now = time.monotonic()
+            if now >= next_ping_deadline:
+                next_ping_deadline = now + PING_INTERVAL_S
+                try:
+                    if mux.sock:
+                        mux.send_line("+ping")
+                except Exception as e:
+                    logger.log(f"[keepalive] send error: {e}")
+                    mux.close()
 
             # heartbeat co 30s (stabilnie, bez spamowania co pętlę)
-            now = time.time()
-            if now - last_hb_emit >= 30.0:
-                last_hb_emit = now
+            if now >= next_hb_deadline:
+                next_hb_deadline = now + HEARTBEAT_INTERVAL_S
                 hb = {
                     "ts": iso_utc_now_ms(),
-                    "pid": os.getpid(),
+                    "pid": _PID,
                     "mux_connected": bool(mux.sock),
                     "last_event_rx_ts": last_event_rx_ts,
                     "last_event_write_ts": last_event_write_ts,
                     "events_written": events_written,
                     "run_id": run_id,
                 }
-                write_json_atomic(hb_path, hb)
+                hb_path.write_bytes(dumps_bytes(hb))
                 logger.log(f"[alive] {hb}")
+                writer.flush()
+                logger.flush()
 
-            time.sleep(0.2)
+            # buforowane zapisy: dopchnij, jeśli minęła sekunda od flush
+            writer.maybe_flush()
+            logger.maybe_flush()
 
     except KeyboardInterrupt:
         logger.log("[bridge] stopping (KeyboardInterrupt)")
@@ -429,7 +547,9 @@ def main() -> int:
         logger.log(f"[bridge] fatal: {e}")
         return 1
     finally:
+        sel.close()
         mux.close()
+        writer.close()
         logger.close()
 
     return 0
@@ -1,13 +1,26 @@
 from __future__ import annotations
 
 import json
+import os
 import time
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Optional, Tuple
 
 import yaml
+from timeutil import iso_utc_now_ms
+from writer import dumps_bytes
+
+try:
+    from yaml import CSafeLoader as _SafeLoader  # libyaml
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
+try:  # Linux: czekamy na zapis do pliku zamiast pollingu
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
 
 
 @dataclass
@@ -21,6 +34,10 @@ class RendererConfig:
     poll_ms: int = 200
 
 
+_PID = os.getpid()
+INOTIFY_TIMEOUT_MS = 1000  # górny limit snu: rotacja dnia i heartbeat
+
+
 def utc_day() -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
@@ -36,12 +53,27 @@ def find_events_file(out_dir: Path, day: str) -> Optional[Path]:
     return p if p.exists() else None
 
 
+# path -> ((st_mtime_ns, st_size), parsed); parsed dicts are shared, treat as read-only
+_LOAD_CACHE: Dict[Path, Tuple[Tuple[int, int], Any]] = {}
+
+
+def _load_cached(path: Path, parse: Callable[[str], Any]) -> Any:
+    st = path.stat()
+    key = (st.st_mtime_ns, st.st_size)
+    hit = _LOAD_CACHE.get(path)
+    if hit and hit[0] == key:
+        return hit[1]
+    parsed = parse(path.read_text(encoding="utf-8"))
+    _LOAD_CACHE[path] = (key, parsed)
+    return parsed
+
+
 def load_yaml(path: Path) -> Dict[str, Any]:
-    return yaml.safe_load(path.read_text(encoding="utf-8")) or {}
+    return _load_cached(path, lambda text: yaml.load(text, Loader=_SafeLoader) or {})
 
 
 def load_json(path: Path) -> Dict[str, Any]:
-    return json.loads(path.read_text(encoding="utf-8"))
+    return _load_cached(path, json.loads)
 
 
 def load_config(path: Path) -> RendererConfig:
@@ -61,10 +93,35 @@ def resolve_name(dbref: str, mapping: Dict[str, str]) -> str:
     return mapping.get(dbref, dbref)
 
 
+DEFAULT_TEMPLATES = {
+    "SAY": "{ts} {actor} {verb}: {raw}  @ {location}",
+    "MOVE": "{ts} {actor} moves",
+}
+
+
+@dataclass(frozen=True)
+class ResolvedTemplates:
+    """Per-type template strings picked once for the configured language."""
+    say: str
+    move: str
+    say_verb: str  # default verb when the event carries none
+
+
+def resolve_templates(templates: Dict[str, Any], lang: str) -> ResolvedTemplates:
+    def pick(etype: str) -> str:
+        by_lang = templates.get(etype) or {}
+        return by_lang.get(lang) or by_lang.get("en") or DEFAULT_TEMPLATES[etype]
+
+    return ResolvedTemplates(
+        say=pick("SAY"),
+        move=pick("MOVE"),
+        say_verb="mówi" if lang == "pl" else "says",
+    )
+
+
 def render_event(
     ev: Dict[str, Any],
-    lang: str,
-    templates: Dict[str, Any],
+    tpl: ResolvedTemplates,
     actors: Dict[str, str],
     locations: Dict[str, str],
 ) -> Optional[str]:
@@ -75,35 +132,59 @@ def render_event(
     actor_name = resolve_name(actor_dbref, actors)
 
     if etype == "SAY":
-        tpl = (
-            templates.get("SAY", {}).get(lang)
-            or templates.get("SAY", {}).get("en")
-            or "{ts} {actor} {verb}: {raw}  @ {location}"
-        )
         loc_dbref = (ev.get("location") or {}).get("dbref") or ""
         loc_name = resolve_name(loc_dbref, locations)
         content = ev.get("content") or {}
         raw = content.get("raw") or ""
-        verb = content.get("verb") or ("mówi" if lang == "pl" else "says")
-        return tpl.format(ts=ts, actor=actor_name, location=loc_name, raw=raw, verb=verb)
+        verb = content.get("verb") or tpl.say_verb
+        return tpl.say.format_map(
+            {"ts": ts, "actor": actor_name, "location": loc_name, "raw": raw, "verb": verb}
+        )
 
     if etype == "MOVE":
-        tpl = templates.get("MOVE", {}).get(lang) or templates.get("MOVE", {}).get("en") or "{ts} {actor} moves"
         content = ev.get("content") or {}
         frm = content.get("from", "")
         to = content.get("to", "")
         frm_name = resolve_name(frm, locations)
         to_name = resolve_name(to, locations)
-        return tpl.format(ts=ts, actor=actor_name, from_loc=frm_name, to_loc=to_name)
+        return tpl.move.format_map(
+            {"ts": ts, "actor": actor_name, "from_loc": frm_name, "to_loc": to_name}
+        )
 
     return None
 
 
+def open_watcher(directory: Path) -> Optional[Any]:
+    """
+    Return an INotify watching directory for appends/new files, or None
+    when inotify is unavailable (callers then fall back to polling).
+    """
+    if INotify is None:
+        return None
+    try:
+        ino = INotify()
+        ino.add_watch(
+            str(directory),
+            inotify_flags.MODIFY | inotify_flags.CREATE | inotify_flags.MOVED_TO,
+        )
+        return ino
+    except OSError as e:
+        print(f"[renderer] inotify setup failed ({e}), polling instead")
+        return None
+
+
+def wait_for_data(watcher: Optional[Any], poll_s: float) -> None:
+    if watcher is None:
+        time.sleep(poll_s)
+    else:
+        watcher.read(timeout=INOTIFY_TIMEOUT_MS)
+
+
 def write_json_atomic(path: Path, payload: Dict[str, Any]) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
     tmp = path.with_suffix(path.suffix + ".tmp")
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False)
+    with open(tmp, "wb") as f:
+        f.write(dumps_bytes(payload))
     tmp.replace(path)
 
 
@@ -114,9 +195,13 @@ def main() -> None:
     ident = load_json(cfg.identity_map_path)
     actors = ident.get("actors", {})
     locations = ident.get("locations", {})
-    templates = load_yaml(cfg.templates_path)
+    templates = resolve_templates(load_yaml(cfg.templates_path), cfg.language)
 
     poll_s = max(cfg.poll_ms, 50) / 1000.0
+    if INotify is None:
+        print(f"[renderer] inotify_simple not installed: polling every {int(poll_s * 1000)} ms")
+    else:
+        print("[renderer] waiting for new lines via inotify")
     hb_path = cfg.out_dir / "renderer.heartbeat.json"
     last_line_ts = time.time()
     last_hb_emit = 0.0
@@ -131,6 +216,7 @@ def main() -> None:
             events_file = find_events_file(cfg.out_dir, day)
 
         print(f"[renderer] following: {events_file}")
+        watcher = open_watcher(events_file.parent)
         with open(events_file, "r", encoding="utf-8") as f:
             if not cfg.from_start:
                 f.seek(0, 2)
@@ -141,11 +227,10 @@ def main() -> None:
                 if current_day != day:
                     break
 
-                pos = f.tell()
+                # po pustym readline() plik zostaje na EOF, tell/seek zbędne
                 line = f.readline()
                 if not line:
-                    f.seek(pos)
-                    time.sleep(poll_s)
+                    wait_for_data(watcher, poll_s)
                 else:
                     line = line.strip()
                     if not line:
@@ -156,7 +241,7 @@ def main() -> None:
                         print(f"[renderer] bad json line: {line[:160]}")
                         continue
 
-                    out = render_event(ev, cfg.language, templates, actors, locations)
+                    out = render_event(ev, templates, actors, locations)
                     if out:
                         print(out)
                     last_line_ts = time.time()
@@ -165,20 +250,16 @@ def main() -> None:
                 if now - last_hb_emit >= 30.0:
                     last_hb_emit = now
                     hb = {
-                        "ts": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
-                        "pid": os.getpid(),
+                        "ts": iso_utc_now_ms(),
+                        "pid": _PID,
                         "last_line_ts": last_line_ts,
                         "following_day": day,
                         "poll_ms": cfg.poll_ms,
                     }
-                    # os.getpid() wymaga os:
-                    # dodamy import lokalnie, żeby było 100% pewne:
-                    try:
-                        import os as _os
-                        hb["pid"] = _os.getpid()
-                    except Exception:
-                        pass
                     write_json_atomic(hb_path, hb)
 
+        if watcher is not None:
+            watcher.close()
+
 if __name__ == "__main__":
     main()
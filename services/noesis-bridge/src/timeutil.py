@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+import time
+
+# strftime tylko raz na sekundę / dobę; reszta to doklejenie milisekund
+_TS_CACHE: list = [-1, ""]  # [epoch_second, "YYYY-MM-DDTHH:MM:SS."]
+_DATE_CACHE: list = [-1, ""]  # [epoch_day, "YYYY-MM-DD"]
+
+
+def iso_utc_now_ms() -> str:
+    t = time.time()
+    sec = int(t)
+    if sec != _TS_CACHE[0]:
+        _TS_CACHE[1] = time.strftime("%Y-%m-%dT%H:%M:%S.", time.gmtime(sec))
+        _TS_CACHE[0] = sec
+    return f"{_TS_CACHE[1]}{int((t - sec) * 1000):03d}Z"
+
+
+def iso_utc_date() -> str:
+    t = int(time.time())
+    day = t // 86400
+    if day != _DATE_CACHE[0]:
+        _DATE_CACHE[1] = time.strftime("%Y-%m-%d", time.gmtime(t))
+        _DATE_CACHE[0] = day
+    return _DATE_CACHE[1]
@@ -1,15 +1,28 @@
 from __future__ import annotations
 
 import json
-from dataclasses import dataclass
-from datetime import datetime, timezone
+import os
+import time
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any, Dict, Optional
 
+BUFFER_SIZE = 64 * 1024
+FLUSH_BYTES = 64 * 1024
+FLUSH_INTERVAL_S = 1.0
+OPEN_FLAGS = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_CLOEXEC", 0)
+JSON_SEPARATORS = (",", ":")  # compact: no ", " / ": " padding
 
-def utc_day() -> str:
-    """Return current UTC day as YYYY-MM-DD."""
-    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+try:
+    import orjson
+
+    def dumps_bytes(obj: Any) -> bytes:
+        """Serialize to compact UTF-8 JSON bytes (orjson when installed)."""
+        return orjson.dumps(obj)
+except ImportError:
+    def dumps_bytes(obj: Any) -> bytes:
+        """Serialize to compact UTF-8 JSON bytes (orjson when installed)."""
+        return json.dumps(obj, ensure_ascii=False, separators=JSON_SEPARATORS).encode("utf-8")
 
 
 def events_path(out_dir: Path, day: str) -> Path:
@@ -32,48 +45,83 @@ class EventWriter:
 
     - Append-only JSON Lines (1 event = 1 line JSON)
     - Daily rotation by UTC date
-    - Flush after each write (SuperPoC safety)
+    - Raw O_APPEND fd + user-space buffer: one os.write() per FLUSH_BYTES,
+      FLUSH_INTERVAL_S, or close; every line lands whole at the end of file
     - Does not interpret or mutate events
     """
     out_dir: Path
-    _current_day: Optional[str] = None
-    _fh: Optional[Any] = None
+    _day_num: int = -1  # time.time() // 86400 of the open file
+    _fd: Optional[int] = None
     _current_path: Optional[Path] = None
+    _buf: bytearray = field(default_factory=bytearray)
+    _last_flush_ts: float = 0.0
 
-    def _ensure_open(self, day: str) -> None:
-        if self._fh and self._current_day == day:
-            return
+    def _ensure_open(self) -> None:
+        t = int(time.time())
+        d = t // 86400
+        if d != self._day_num or self._fd is None:
+            self._rotate(d, t)
 
-        # rotate
+    def _rotate(self, day_num: int, t: int) -> None:
         self.close()
 
+        day = time.strftime("%Y-%m-%d", time.gmtime(t))
         path = events_path(self.out_dir, day)
-        self._fh = open(path, "a", encoding="utf-8")
-        self._current_day = day
+        self._fd = os.open(path, OPEN_FLAGS, 0o644)
+        self._day_num = day_num
         self._current_path = path
+        self._last_flush_ts = time.monotonic()
 
     def write_event(self, event: Dict[str, Any]) -> Path:
         """
         Write a single event as one JSONL line.
         Returns the file path used.
         """
-        day = utc_day()
-        self._ensure_open(day)
+        path = self.append_event(event)
+        self.maybe_flush()
+        return path
+
+    def append_event(self, event: Dict[str, Any]) -> Path:
+        """
+        Buffer one event, flushing only at FLUSH_BYTES. The caller runs
+        maybe_flush() once after e.g. everything parsed from one recv, so
+        those events reach the file together in one os.write().
+        Returns the file path used.
+        """
+        self._ensure_open()
 
         # Ensure JSON serializable (no mutation)
-        line = json.dumps(event, ensure_ascii=False)
-        self._fh.write(line + "\n")
-        self._fh.flush()
+        self._buf += dumps_bytes(event)
+        self._buf += b"\n"
+        if len(self._buf) >= FLUSH_BYTES:
+            self.flush()
 
         # type: ignore[return-value]
         return self._current_path
 
+    def maybe_flush(self) -> None:
+        """Flush pending data if FLUSH_INTERVAL_S has passed since the last flush."""
+        if self._buf and time.monotonic() - self._last_flush_ts >= FLUSH_INTERVAL_S:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._fd is not None:
+            buf = self._buf
+            while buf:
+                # drop what was written right away, so an error on a later
+                # write cannot make the next flush repeat it
+                del buf[:os.write(self._fd, buf)]
+        self._last_flush_ts = time.monotonic()
+
     def close(self) -> None:
-        if self._fh:
+        if self._fd is not None:
             try:
-                self._fh.close()
-            except Exception:
-                pass
-        self._fh = None
-        self._current_day = None
+                self.flush()
+            finally:
+                try:
+                    os.close(self._fd)
+                except Exception:
+                    pass
+        self._fd = None
+        self._day_num = -1
         self._current_path = None